@@ -17,23 +17,42 @@ Date:
 import argparse
 import pandas as pd
 import requests
-import json
 import re
 import logging
 import sys
 import os
 import tarfile
+import shutil
+import subprocess
+import tempfile
+import threading
 import math
+from concurrent.futures import ThreadPoolExecutor
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 import time  # Imported time module for delays
 
-def validate_file_ids(file_ids):
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Buffer size used when reading and extracting tar archives (the tarfile default is 16 KiB)
+TAR_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Maximum number of file IDs sent in a single validation request
+VALIDATION_CHUNK_SIZE = 5000
+
+# Extracts the file name from a Content-Disposition response header
+CONTENT_DISPOSITION_FILENAME_RE = re.compile(r'filename="*(.+?)"*$')
+
+def validate_file_ids(file_ids, session):
     """
     Validates the list of file IDs by checking them against the GDC API.
 
     Args:
         file_ids (list): List of file IDs to validate.
+        session (requests.Session): Session used for the validation request.
 
     Returns:
         list: List of valid file IDs.
@@ -41,50 +60,67 @@ def validate_file_ids(file_ids):
     logger = logging.getLogger(__name__)
     files_endpt = "https://api.gdc.cancer.gov/files"
 
-    # Prepare parameters to check file IDs
-    check_params = {
-        "filters": {
-            "op": "in",
-            "content": {
-                "field": "file_id",
-                "value": file_ids
-            }
-        },
-        "fields": "file_id",
-        "format": "JSON",
-        "size": len(file_ids)
-    }
-
+    valid_file_ids = []
     try:
-        # Make the POST request
         logger.info("Validating file IDs...")
-        response = requests.post(
-            files_endpt,
-            headers={"Content-Type": "application/json"},
-            data=json.dumps(check_params),
-            timeout=60  # Set a timeout for the request
-        )
-
-        if response.status_code == 200:
-            data = response.json()
-            valid_file_ids = [f['file_id'] for f in data['data']['hits']]
-            invalid_file_ids = set(file_ids) - set(valid_file_ids)
-            if invalid_file_ids:
-                logger.warning(f"Invalid File IDs found and will be skipped: {invalid_file_ids}")
+        # Large sample sheets are validated in chunks, one POST per chunk
+        for start_idx in range(0, len(file_ids), VALIDATION_CHUNK_SIZE):
+            chunk_file_ids = file_ids[start_idx:start_idx + VALIDATION_CHUNK_SIZE]
+
+            # Prepare parameters to check file IDs
+            check_params = {
+                "filters": {
+                    "op": "in",
+                    "content": {
+                        "field": "file_id",
+                        "value": chunk_file_ids
+                    }
+                },
+                "fields": "file_id",
+                "format": "JSON",
+                "size": len(chunk_file_ids)
+            }
+
+            # Make the POST request, serializing the ID list with orjson when it is available
+            if orjson is not None:
+                response = session.post(
+                    files_endpt,
+                    data=orjson.dumps(check_params),
+                    headers={"Content-Type": "application/json"},
+                    timeout=60  # Set a timeout for the request
+                )
             else:
-                logger.info("All File IDs are valid.")
-            return valid_file_ids
-        else:
-            logger.error(f"Error checking file IDs (status code {response.status_code})")
-            logger.debug(f"Response: {response.text}")
-            sys.exit(1)
+                response = session.post(
+                    files_endpt,
+                    json=check_params,
+                    timeout=60  # Set a timeout for the request
+                )
+
+            if response.status_code != 200:
+                logger.error("Error checking file IDs (status code %s)", response.status_code)
+                logger.debug("Response: %s", response.text)
+                sys.exit(1)
+
+            data = orjson.loads(response.content) if orjson is not None else response.json()
+            valid_file_ids.extend(f['file_id'] for f in data['data']['hits'])
     except Exception as e:
-        logger.exception(f"An error occurred during file ID validation: {e}")
+        logger.exception("An error occurred during file ID validation: %s", e)
         sys.exit(1)
 
-def create_session_with_retries():
+    invalid_file_ids = set(file_ids) - set(valid_file_ids)
+    if invalid_file_ids:
+        logger.warning("Invalid File IDs found and will be skipped: %s", invalid_file_ids)
+    else:
+        logger.info("All File IDs are valid.")
+    return valid_file_ids
+
+def create_session_with_retries(concurrent_downloads):
     """
-    Creates a requests Session with retry logic.
+    Creates a requests Session with retry logic and a connection pool large enough
+    to keep one kept-alive connection per concurrent download.
+
+    Args:
+        concurrent_downloads (int): Maximum number of requests made concurrently with the session.
 
     Returns:
         requests.Session: Session object with retries configured.
@@ -97,11 +133,196 @@ def create_session_with_retries():
         allowed_methods=["POST"],
         raise_on_status=False
     )
-    adapter = HTTPAdapter(max_retries=retries)
+    adapter = HTTPAdapter(pool_maxsize=concurrent_downloads, max_retries=retries)
     session.mount('https://', adapter)
     session.mount('http://', adapter)
+    session.headers.update({"Connection": "keep-alive"})
     return session
 
+def extract_tar_stream(response, extract_path):
+    """
+    Extracts a streamed tar.gz HTTP response into a directory without saving the archive.
+
+    The response body is received on a separate thread and piped to the extractor, so network
+    reads overlap with decompression and disk writes. When pigz is installed, decompression is
+    done by a pigz subprocess using multiple cores; otherwise the stream is decompressed by tarfile.
+
+    Args:
+        response (requests.Response): Streaming response whose body is a tar.gz archive.
+        extract_path (str): Directory where the files will be extracted.
+    """
+    pigz_path = shutil.which('pigz')
+    if pigz_path is not None:
+        pigz = subprocess.Popen([pigz_path, '-dc'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                bufsize=TAR_BUFFER_SIZE)
+        sink, source, tar_mode = pigz.stdin, pigz.stdout, "r|"
+    else:
+        pigz = None
+        read_fd, write_fd = os.pipe()
+        sink = open(write_fd, "wb", buffering=TAR_BUFFER_SIZE)
+        source = open(read_fd, "rb", buffering=TAR_BUFFER_SIZE)
+        tar_mode = "r|gz"
+
+    feed_errors = []
+
+    def feed(sink):
+        # Pump the response body into the pipe while tarfile reads from the other end
+        try:
+            for chunk in response.iter_content(chunk_size=TAR_BUFFER_SIZE):
+                if chunk:
+                    sink.write(chunk)
+        except Exception as e:
+            feed_errors.append(e)
+        finally:
+            try:
+                sink.close()
+            except OSError:
+                pass
+
+    feeder = threading.Thread(target=feed, args=(sink,), daemon=True)
+    feeder.start()
+    try:
+        with tarfile.open(fileobj=source, mode=tar_mode, bufsize=TAR_BUFFER_SIZE) as tar:
+            tar.copybufsize = TAR_BUFFER_SIZE  # Used by extractall on Python 3.8+
+            tar.extractall(path=extract_path)
+        # Drain any trailing padding so pigz and the feeder thread can finish
+        while source.read(TAR_BUFFER_SIZE):
+            pass
+    except BaseException:
+        # Close the reading end (and stop pigz) so a feeder blocked on a full pipe is released
+        if pigz is not None:
+            pigz.kill()
+        source.close()
+        raise
+    finally:
+        feeder.join()
+        source.close()
+        if pigz is not None:
+            pigz.wait()
+
+    if feed_errors:
+        raise feed_errors[0]
+    if pigz is not None and pigz.returncode != 0:
+        raise Exception(f"pigz exited with status {pigz.returncode}")
+
+def move_into_place(source_dir, destination_dir):
+    """
+    Moves the contents of a directory into another directory, merging subdirectories that already exist.
+
+    Args:
+        source_dir (str): Directory whose contents are moved.
+        destination_dir (str): Directory the contents are moved into; existing files are replaced.
+    """
+    with os.scandir(source_dir) as entries:
+        for entry in entries:
+            destination_path = os.path.join(destination_dir, entry.name)
+            if entry.is_dir(follow_symlinks=False) and os.path.isdir(destination_path):
+                move_into_place(entry.path, destination_path)
+            else:
+                os.replace(entry.path, destination_path)
+
+def save_and_extract(response, outputs_dir, default_name):
+    """
+    Saves a successful data endpoint response into the output directory, extracting tar.gz archives.
+
+    Args:
+        response (requests.Response): Streaming response from the GDC data endpoint.
+        outputs_dir (str): Directory where the data will be saved.
+        default_name (str): File name to use when the response does not provide one.
+    """
+    logger = logging.getLogger(__name__)
+
+    # Get the file name from the response headers
+    response_head_cd = response.headers.get("Content-Disposition", "")
+    file_name_match = CONTENT_DISPOSITION_FILENAME_RE.search(response_head_cd)
+    if file_name_match:
+        file_name = file_name_match.group(1)
+    else:
+        file_name = default_name
+    logger.debug("Received file name: %s", file_name)
+
+    if file_name.endswith(".tar.gz"):
+        # Extract the tar.gz stream without saving the archive. The files are extracted into a temporary
+        # directory and only moved into place once the whole archive has been read, so a broken stream
+        # does not leave truncated files in the outputs directory.
+        extract_dir = tempfile.mkdtemp(prefix=".extract_", dir=outputs_dir)
+        try:
+            logger.debug("Extracting files to %s", extract_dir)
+            extract_tar_stream(response, extract_dir)
+            move_into_place(extract_dir, outputs_dir)
+        finally:
+            shutil.rmtree(extract_dir, ignore_errors=True)
+        logger.info("Files extracted to %s", outputs_dir)
+    else:
+        # Single files are not archived; save the content to a temporary file in the outputs directory
+        # and rename it once the download is complete
+        file_path = os.path.join(outputs_dir, file_name)
+        partial_path = file_path + ".part"
+        try:
+            with open(partial_path, "wb") as output_file:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):  # 1 MB chunks
+                    if chunk:
+                        output_file.write(chunk)
+            os.replace(partial_path, file_path)
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        logger.info("Downloaded data saved to %s", file_path)
+
+def download_batch(session, data_endpt, batch_file_ids, batch_num, num_batches, outputs_dir):
+    """
+    Downloads a single batch of files from the GDC data endpoint and extracts it into the output directory.
+
+    Args:
+        session (requests.Session): Session used for the download requests.
+        data_endpt (str): GDC data endpoint URL.
+        batch_file_ids (list): File IDs to download in this batch.
+        batch_num (int): Zero-based index of the batch.
+        num_batches (int): Total number of batches.
+        outputs_dir (str): Directory where the data will be saved.
+
+    Returns:
+        bool: True if the batch was downloaded successfully, False if it was skipped.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info("Downloading batch %s/%s with %s file IDs.", batch_num + 1, num_batches, len(batch_file_ids))
+
+    # Parameters
+    params = {"ids": batch_file_ids}
+
+    # The session already retries connection errors and 429/5xx responses; these attempts
+    # cover failures while the response body is being streamed and extracted
+    retry_attempts = 3
+    for attempt in range(retry_attempts + 1):
+        if attempt:
+            logger.info("Retry attempt %s for batch %s", attempt, batch_num + 1)
+        try:
+            # Make the POST request with a timeout
+            with session.post(
+                data_endpt,
+                json=params,
+                stream=True,  # Stream the content to handle large files
+                timeout=300  # Increased timeout to 5 minutes
+            ) as response:
+                # Check if the request was successful
+                if response.status_code != 200:
+                    logger.error("Error: Unable to download files in batch %s (status code %s)", batch_num + 1, response.status_code)
+                    logger.debug("Response headers: %s", response.headers)
+                    logger.debug("Response content: %s", response.text)
+                    raise Exception(f"Download failed with status code {response.status_code}")
+
+                save_and_extract(response, outputs_dir, f"gdc_download_batch_{batch_num + 1}.tar.gz")
+            return True
+
+        except Exception as e:
+            logger.exception("An error occurred while downloading batch %s: %s", batch_num + 1, e)
+            if attempt < retry_attempts:
+                time.sleep(5)
+
+    logger.error("All retry attempts failed for batch %s. Skipping this batch.", batch_num + 1)
+    return False
+
 def main():
     # Set up argument parser
     parser = argparse.ArgumentParser(description='Download TCGA data from a custom cohort sample sheet.')
@@ -109,11 +330,21 @@ def main():
                         help='Path to the sample sheet TSV file downloaded from the GDC portal.')
     parser.add_argument('--output-directory', type=str, default=os.path.join(os.getcwd(), 'outputs'),
                         help='Path to the output directory where data will be saved. Default is ./outputs')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='Maximum number of files requested per download batch. Default is 500.')
+    parser.add_argument('--concurrent-downloads', type=int, default=4,
+                        help='Maximum number of batches to download concurrently. Default is 4.')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Enable debug logging, including a message for every processed file.')
     args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.concurrent_downloads < 1:
+        parser.error("--concurrent-downloads must be at least 1")
 
     # Set up logging
     logging.basicConfig(
-        level=logging.INFO,
+        level=logging.DEBUG if args.verbose else logging.INFO,
         format='[%(asctime)s] %(levelname)s:%(name)s: %(message)s',
         handlers=[
             logging.FileHandler("download_tcga_data.log"),
@@ -127,13 +358,13 @@ def main():
         outputs_dir = args.output_directory
         if not os.path.exists(outputs_dir):
             os.makedirs(outputs_dir)
-            logger.info(f"Created outputs directory at {outputs_dir}")
+            logger.info("Created outputs directory at %s", outputs_dir)
         else:
-            logger.info(f"Using existing outputs directory at {outputs_dir}")
+            logger.info("Using existing outputs directory at %s", outputs_dir)
 
         # Read the sample sheet
         sample_sheet_path = args.sample_sheet
-        logger.info(f"Reading sample sheet from {sample_sheet_path}")
+        logger.info("Reading sample sheet from %s", sample_sheet_path)
         sample_sheet = pd.read_csv(sample_sheet_path, sep="\t")
 
         # Check if 'File ID' column exists
@@ -143,15 +374,18 @@ def main():
 
         # Get the list of File IDs
         file_ids = sample_sheet['File ID'].dropna().unique().tolist()
-        logger.info(f"Number of file IDs in sample sheet: {len(file_ids)}")
+        logger.info("Number of file IDs in sample sheet: %s", len(file_ids))
 
         if not file_ids:
             logger.error("No File IDs found in the sample sheet.")
             sys.exit(1)
 
+        # Create a session with retries, shared by validation and all downloads
+        session = create_session_with_retries(args.concurrent_downloads)
+
         # Validate File IDs
-        valid_file_ids = validate_file_ids(file_ids)
-        logger.info(f"Number of valid file IDs: {len(valid_file_ids)}")
+        valid_file_ids = validate_file_ids(file_ids, session)
+        logger.info("Number of valid file IDs: %s", len(valid_file_ids))
 
         if not valid_file_ids:
             logger.error("No valid File IDs found after validation.")
@@ -161,133 +395,36 @@ def main():
         data_endpt = "https://api.gdc.cancer.gov/data"
 
         # Maximum number of IDs per request
-        max_ids_per_request = 100  # Reduced batch size to prevent server overload
+        max_ids_per_request = args.batch_size
 
         # Calculate the number of batches
         num_batches = math.ceil(len(valid_file_ids) / max_ids_per_request)
 
-        # Create a session with retries
-        session = create_session_with_retries()
-
-        for batch_num in range(num_batches):
-            start_idx = batch_num * max_ids_per_request
-            end_idx = min(start_idx + max_ids_per_request, len(valid_file_ids))
-            batch_file_ids = valid_file_ids[start_idx:end_idx]
-            logger.info(f"Downloading batch {batch_num + 1}/{num_batches} with {len(batch_file_ids)} file IDs.")
-
-            # Parameters
-            params = {"ids": batch_file_ids}
+        # Download batches concurrently; each batch is network-bound, so threads overlap the waits
+        batches = [valid_file_ids[start_idx:start_idx + max_ids_per_request]
+                   for start_idx in range(0, len(valid_file_ids), max_ids_per_request)]
+        logger.info("Downloading %s batches with up to %s concurrent downloads.", num_batches, args.concurrent_downloads)
 
+        with ThreadPoolExecutor(max_workers=args.concurrent_downloads) as executor:
+            futures = [
+                executor.submit(download_batch, session, data_endpt, batch_file_ids, batch_num, num_batches, outputs_dir)
+                for batch_num, batch_file_ids in enumerate(batches)
+            ]
             try:
-                # Make the POST request with a timeout
-                response = session.post(
-                    data_endpt,
-                    data=json.dumps(params),
-                    headers={"Content-Type": "application/json"},
-                    stream=True,  # Stream the content to handle large files
-                    timeout=300  # Increased timeout to 5 minutes
-                )
-
-                # Check if the request was successful
-                if response.status_code == 200:
-                    # Get the file name from the response headers
-                    response_head_cd = response.headers.get("Content-Disposition", "")
-                    file_name_match = re.findall(r'filename="*(.+?)"*$', response_head_cd)
-                    if file_name_match:
-                        file_name = file_name_match[0]
-                    else:
-                        file_name = f"gdc_download_batch_{batch_num + 1}.tar.gz"
-                    logger.debug(f"Received file name: {file_name}")
-
-                    # Save the content to a file in the outputs directory
-                    file_path = os.path.join(outputs_dir, file_name)
-                    with open(file_path, "wb") as output_file:
-                        for chunk in response.iter_content(chunk_size=1024 * 1024):  # 1 MB chunks
-                            if chunk:
-                                output_file.write(chunk)
-                    logger.info(f"Downloaded data saved to {file_path}")
-
-                    # Extract the tar.gz file into outputs directory
-                    if file_name.endswith(".tar.gz"):
-                        extract_path = outputs_dir  # Extract into outputs directory
-                        logger.debug(f"Extracting files to {extract_path}")
-                        with tarfile.open(file_path, "r:gz") as tar:
-                            tar.extractall(path=extract_path)
-                        logger.info(f"Files extracted to {extract_path}")
-
-                        # Optionally, remove the tar.gz file after extraction
-                        os.remove(file_path)
-                        logger.debug(f"Removed archive file {file_path}")
-
-                else:
-                    logger.error(f"Error: Unable to download files in batch {batch_num + 1} (status code {response.status_code})")
-                    logger.debug(f"Response headers: {response.headers}")
-                    logger.debug(f"Response content: {response.text}")
-                    raise Exception(f"Download failed with status code {response.status_code}")
-
-            except Exception as e:
-                logger.exception(f"An error occurred while downloading batch {batch_num + 1}: {e}")
-                logger.info("Retrying the failed batch...")
-
-                # Implement a simple retry mechanism for the failed batch
-                retry_attempts = 3
-                for attempt in range(1, retry_attempts + 1):
-                    logger.info(f"Retry attempt {attempt} for batch {batch_num + 1}")
-                    try:
-                        response = session.post(
-                            data_endpt,
-                            data=json.dumps(params),
-                            headers={"Content-Type": "application/json"},
-                            stream=True,
-                            timeout=300
-                        )
-                        if response.status_code == 200:
-                            # Process the response as before
-                            response_head_cd = response.headers.get("Content-Disposition", "")
-                            file_name_match = re.findall(r'filename="*(.+?)"*$', response_head_cd)
-                            if file_name_match:
-                                file_name = file_name_match[0]
-                            else:
-                                file_name = f"gdc_download_batch_{batch_num + 1}_retry_{attempt}.tar.gz"
-                            logger.debug(f"Received file name: {file_name}")
-
-                            # Save the content to a file in the outputs directory
-                            file_path = os.path.join(outputs_dir, file_name)
-                            with open(file_path, "wb") as output_file:
-                                for chunk in response.iter_content(chunk_size=1024 * 1024):
-                                    if chunk:
-                                        output_file.write(chunk)
-                            logger.info(f"Downloaded data saved to {file_path}")
-
-                            # Extract the tar.gz file into outputs directory
-                            if file_name.endswith(".tar.gz"):
-                                extract_path = outputs_dir
-                                logger.debug(f"Extracting files to {extract_path}")
-                                with tarfile.open(file_path, "r:gz") as tar:
-                                    tar.extractall(path=extract_path)
-                                logger.info(f"Files extracted to {extract_path}")
-
-                                # Remove the tar.gz file after extraction
-                                os.remove(file_path)
-                                logger.debug(f"Removed archive file {file_path}")
-
-                            # Break out of retry loop on success
-                            break
-                        else:
-                            logger.error(f"Retry {attempt} failed with status code {response.status_code}")
-                            if attempt == retry_attempts:
-                                logger.error(f"All retry attempts failed for batch {batch_num + 1}. Skipping this batch.")
-                            else:
-                                time.sleep(5)
-                    except Exception as retry_exception:
-                        logger.exception(f"Retry {attempt} encountered an error: {retry_exception}")
-                        if attempt == retry_attempts:
-                            logger.error(f"All retry attempts failed for batch {batch_num + 1}. Skipping this batch.")
-                        else:
-                            time.sleep(5)
+                failed_batches = [batch_num + 1 for batch_num, future in enumerate(futures) if not future.result()]
+            except BaseException:
+                # Do not start the remaining batches on an error or Ctrl-C; running downloads finish first
+                for future in futures:
+                    future.cancel()
+                raise
+
+        if failed_batches:
+            logger.error("The following batches could not be downloaded: %s", failed_batches)
+        else:
+            logger.info("All batches downloaded successfully.")
 
     except Exception as e:
-        logger.exception(f"An unexpected error occurred: {e}")
+        logger.exception("An unexpected error occurred: %s", e)
         sys.exit(1)
 
 if __name__ == "__main__":
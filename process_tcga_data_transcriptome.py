@@ -20,8 +20,189 @@ import os
 import sys
 import argparse
 import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-from functools import reduce
+from tcga_combine import available_cpu_count, locate_sample_files, setup_logging
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+    pacsv = None
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+# Number of summary rows (N_unmapped, N_multimapping, N_noFeature, N_ambiguous) at the top of STAR gene counts
+NUM_STAR_SUMMARY_ROWS = 4
+
+def read_tsv_header(file_path):
+    """
+    Reads the leading comment lines and the column header of a TSV file.
+
+    Args:
+        file_path (str): Path to the TSV file.
+
+    Returns:
+        tuple: Number of leading '#' comment lines and the list of column names.
+    """
+    num_comment_lines = 0
+    with open(file_path, 'r') as tsv_file:
+        for line in tsv_file:
+            if not line.startswith('#'):
+                return num_comment_lines, line.rstrip('\r\n').split('\t')
+            num_comment_lines += 1
+    return num_comment_lines, []
+
+def parse_expression_file(file_path, sample_id, expression_columns, float_dtype):
+    """
+    Reads a single RNA-Seq TSV file and returns its expression columns renamed with the sample identifier.
+
+    Runs in a worker process, so only the selected columns are returned to the parent.
+
+    Args:
+        file_path (str): Path to the RNA-Seq TSV file.
+        sample_id (str): Sample identifier appended to the expression column names.
+        expression_columns (list): Expression columns to keep, or None to keep all expression columns.
+        float_dtype (str): Precision of the floating-point expression columns, 'float32' or 'float64'.
+
+    Returns:
+        pandas.DataFrame: Expression data indexed by 'gene_id' and 'gene_name', or None if the file was skipped.
+    """
+    logger = logging.getLogger(__name__)
+    logger.debug("Processing file: %s", file_path)
+
+    # Read the header
+    try:
+        num_comment_lines, columns = read_tsv_header(file_path)
+    except Exception as e:
+        logger.error("Failed to read file %s: %s", file_path, e)
+        return None
+
+    # Check that 'gene_id' and 'gene_name' are in the columns
+    if 'gene_id' not in columns or 'gene_name' not in columns:
+        logger.error("'gene_id' or 'gene_name' column not found in file %s. Skipping.", file_path)
+        return None
+
+    # Select expression columns
+    if expression_columns:
+        missing_cols = set(expression_columns) - set(columns)
+        if missing_cols:
+            logger.warning("The following expression columns are missing in file %s: %s", file_path, missing_cols)
+        selected_columns = [col for col in expression_columns if col in columns]
+    else:
+        # Exclude 'gene_id', 'gene_name', and any columns that start with '__'
+        selected_columns = [col for col in columns if col not in ['gene_id', 'gene_name'] and not col.startswith('__')]
+
+    if not selected_columns:
+        logger.warning("No valid expression columns found in file %s. Skipping.", file_path)
+        return None
+
+    # Read the data, keeping 'gene_id' and 'gene_name' as strings; the pyarrow reader returns Arrow-backed
+    # columns (pd.ArrowDtype), which pandas only supports well enough from 2.0 on
+    try:
+        if pacsv is not None and int(pd.__version__.split('.')[0]) >= 2:
+            # pyarrow only materializes the selected columns; files are parsed in one thread, as each worker
+            # process already has a CPU of its own and Arrow's thread pool would oversubscribe the job's CPUs
+            table = pacsv.read_csv(
+                file_path,
+                read_options=pacsv.ReadOptions(skip_rows=num_comment_lines, block_size=8 << 20, use_threads=False),
+                parse_options=pacsv.ParseOptions(delimiter='\t'),
+                convert_options=pacsv.ConvertOptions(
+                    column_types={'gene_id': pa.string(), 'gene_name': pa.string()},
+                    # Read empty gene names as null, as pandas does
+                    strings_can_be_null=True,
+                    include_columns=['gene_id', 'gene_name'] + selected_columns
+                )
+            )
+            if float_dtype == 'float32':
+                # Store values such as TPM and FPKM in single precision; integer counts are left unchanged
+                table = table.cast(pa.schema([
+                    pa.field(field.name, pa.float32()) if pa.types.is_float64(field.type) else field
+                    for field in table.schema
+                ]))
+            df = table.to_pandas(types_mapper=pd.ArrowDtype, use_threads=False)
+        else:
+            df = pd.read_csv(
+                file_path,
+                sep='\t',
+                comment='#',
+                usecols=['gene_id', 'gene_name'] + selected_columns,
+                dtype={'gene_id': str, 'gene_name': str}
+            )
+            # Keep integer counts as integers when genes missing from some files are filled in with NA,
+            # as the pyarrow reader does; plain int64 columns would become floats (e.g. '1177.0')
+            int_columns = df.columns[df.dtypes == 'int64']
+            df[int_columns] = df[int_columns].astype('Int64')
+            if float_dtype == 'float32':
+                float_columns = df.columns[df.dtypes == 'float64']
+                df[float_columns] = df[float_columns].astype('float32')
+    except Exception as e:
+        logger.error("Failed to read file %s: %s", file_path, e)
+        return None
+
+    # Exclude rows where 'gene_id' starts with 'N_' or 'gene_name' is null; STAR gene counts list their
+    # N_ summary rows first, so those are sliced off without scanning every gene_id
+    leading_summary_rows = df['gene_id'].iloc[:NUM_STAR_SUMMARY_ROWS + 1].str.startswith('N_', na=False).tolist()
+    if leading_summary_rows == [True] * NUM_STAR_SUMMARY_ROWS + [False]:
+        df = df.iloc[NUM_STAR_SUMMARY_ROWS:]
+        missing_gene_name = df['gene_name'].isnull()
+        if missing_gene_name.any():
+            df = df[~missing_gene_name]
+    else:
+        df = df[~(df['gene_id'].str.startswith('N_', na=False) | df['gene_name'].isnull())]
+
+    # Index by 'gene_id' and 'gene_name' and keep the selected expression columns
+    df_selected = df.set_index(['gene_id', 'gene_name'])[selected_columns]
+    if not df_selected.index.is_unique:
+        logger.warning("Duplicate genes found in file %s. Keeping the first occurrence.", file_path)
+        df_selected = df_selected[~df_selected.index.duplicated()]
+
+    # Rename the expression columns to include the sample identifier
+    return df_selected.rename(columns={col: f"{col}_{sample_id}" for col in selected_columns})
+
+def write_combined_tsv(combined_df, output_file_path):
+    """
+    Writes the combined expression data to a TSV file, with the index as the leading columns.
+
+    When pyarrow is available the rows are formatted by Arrow's CSV writer in batches, which is much
+    faster than pandas for wide numeric frames; otherwise, or if a value would need quoting, pandas is used.
+    Floating-point columns are formatted by numpy, as pandas does, so both writers produce the same file.
+
+    Args:
+        combined_df (pandas.DataFrame): Combined expression data indexed by 'gene_id' and 'gene_name'.
+        output_file_path (str): Path of the TSV file to write.
+    """
+    if pacsv is not None:
+        try:
+            table = pa.Table.from_pandas(combined_df, preserve_index=True)
+            table = table.select(list(combined_df.index.names) + list(combined_df.columns))
+            with open(output_file_path, 'wb') as output_handle:
+                # Write the header without the quotes Arrow would add around the column names
+                output_handle.write(('\t'.join(table.column_names) + '\n').encode())
+                write_options = pacsv.WriteOptions(include_header=False, delimiter='\t', quoting_style='none')
+                # Arrow formats floats differently from pandas (e.g. '1177' for 1177.0 and '0.00001' for 1e-05),
+                # so floating-point columns are written as the strings pandas would write
+                output_schema = pa.schema([pa.field(field.name, pa.string()) if pa.types.is_floating(field.type) else field
+                                           for field in table.schema])
+                with pacsv.CSVWriter(output_handle, output_schema, write_options=write_options) as writer:
+                    for batch in table.to_batches(max_chunksize=4096):
+                        columns = []
+                        for column in batch.columns:
+                            if pa.types.is_floating(column.type):
+                                values = column.to_numpy(zero_copy_only=False)
+                                column = pa.array(values.astype(str), mask=np.isnan(values))
+                            columns.append(column)
+                        writer.write_batch(pa.RecordBatch.from_arrays(columns, schema=output_schema))
+            return
+        except (TypeError, pa.ArrowInvalid) as e:
+            logging.getLogger(__name__).debug("Falling back to pandas to write %s: %s", output_file_path, e)
+
+    combined_df.to_csv(output_file_path, sep='\t')
 
 def main():
     # Set up argument parser
@@ -36,121 +217,117 @@ def main():
                         help='Name of the output combined TSV file.')
     parser.add_argument('--expression-columns', nargs='*', default=None,
                         help='List of expression columns to extract from the TSV files. Default is all expression columns.')
+    parser.add_argument('--dtype', choices=['float32', 'float64'], default='float32',
+                        help='Precision of floating-point expression values such as TPM and FPKM; integer counts are not changed. Default is float32.')
+    parser.add_argument('--workers', type=int, default=available_cpu_count(),
+                        help='Number of worker processes used to parse the TSV files. Default is the number of CPUs available to the job.')
+    parser.add_argument('--no-parquet', action='store_true',
+                        help='Do not write a Parquet copy of the combined data next to the TSV file.')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Enable debug logging, including a message for every processed file.')
     args = parser.parse_args()
 
     # Set up logging
-    logging.basicConfig(
-        level=logging.INFO,
-        format='[%(asctime)s] %(levelname)s:%(name)s: %(message)s',
-        handlers=[
-            logging.FileHandler("process_tcga_data_rnaseq.log"),
-            logging.StreamHandler(sys.stdout)
-        ]
-    )
+    log_file = "process_tcga_data_rnaseq.log"
+    setup_logging(log_file, args.verbose)
     logger = logging.getLogger(__name__)
 
     try:
         # Read the sample sheet
         sample_sheet_path = args.sample_sheet
-        logger.info(f"Reading sample sheet from {sample_sheet_path}")
+        logger.info("Reading sample sheet from %s", sample_sheet_path)
         sample_sheet = pd.read_csv(sample_sheet_path, sep="\t")
 
         # Ensure required columns are present
         required_columns = ['File ID', 'File Name', 'Project ID', 'Case ID', 'Sample ID']
         missing_columns = set(required_columns) - set(sample_sheet.columns)
         if missing_columns:
-            logger.error(f"The following required columns are missing from the sample sheet: {missing_columns}")
+            logger.error("The following required columns are missing from the sample sheet: %s", missing_columns)
             sys.exit(1)
 
         # Create a sample identifier for each file to ensure uniqueness
-        sample_sheet['Sample Identifier'] = sample_sheet.apply(
-            lambda row: f"{row['Project ID']}_{row['Case ID']}_{row['Sample ID']}_{row['File ID']}", axis=1)
-        file_name_to_sample_id = dict(zip(sample_sheet['File Name'], sample_sheet['Sample Identifier']))
+        # Missing values are written as 'nan'; with pandas string columns astype(str) keeps them missing, so na_rep is needed
+        sample_sheet['Sample Identifier'] = sample_sheet['Project ID'].astype(str).str.cat(
+            [sample_sheet[col].astype(str) for col in ('Case ID', 'Sample ID', 'File ID')], sep='_', na_rep='nan')
 
-        # Initialize a list to hold individual DataFrames
+        # Initialize lists to hold the files to parse and the resulting DataFrames
+        expression_files = []
         data_frames = []
+        seen_sample_ids = set()
         num_files_processed = 0
 
-        # Iterate over the extracted files
+        # Locate the extracted files listed in the sample sheet
         file_directory = args.file_directory
-        logger.info(f"Processing extracted files in {file_directory}")
+        logger.info("Processing extracted files in %s", file_directory)
 
-        for root, dirs, files in os.walk(file_directory):
-            for file in files:
-                file_path = os.path.join(root, file)
-                # Skip non-TSV files
-                if not file.endswith('.tsv'):
-                    continue
-
-                # Get the File Name
-                file_name = file
-                logger.info(f"Processing file: {file_path}")
+        sample_ids = sample_sheet['Sample Identifier'].tolist()
+        for file_path, row_position in locate_sample_files(file_directory, sample_sheet, '.tsv'):
+            # Get the sample identifier
+            sample_id = sample_ids[row_position]
 
-                # Check if the File Name is in the sample sheet
-                if file_name not in file_name_to_sample_id:
-                    logger.warning(f"File Name '{file_name}' not found in sample sheet. Skipping.")
-                    continue
+            # The same file may be extracted more than once; combine only one copy
+            if sample_id in seen_sample_ids:
+                logger.warning("File Name '%s' was found more than once. Skipping duplicate at %s.",
+                               os.path.basename(file_path), file_path)
+                continue
+            seen_sample_ids.add(sample_id)
 
-                # Get the sample identifier
-                sample_id = file_name_to_sample_id[file_name]
-
-                # Read the data
-                try:
-                    df = pd.read_csv(file_path, sep='\t', comment='#')
-                except Exception as e:
-                    logger.error(f"Failed to read file {file_path}: {e}")
-                    continue
+            # Queue the file with its sample identifier
+            expression_files.append((file_path, sample_id))
 
-                # Check that 'gene_id' and 'gene_name' are in the columns
-                if 'gene_id' not in df.columns or 'gene_name' not in df.columns:
-                    logger.error(f"'gene_id' or 'gene_name' column not found in file {file_path}. Skipping.")
+        # Parse the files in parallel; results are collected in sample sheet order so the output is stable
+        logger.info("Parsing %s files with up to %s worker processes", len(expression_files), args.workers)
+        # The workers set up the same logging, so their per-file messages are kept whatever the start method
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=setup_logging,
+                                 initargs=(log_file, args.verbose)) as executor:
+            results = executor.map(
+                parse_expression_file,
+                [file_path for file_path, _ in expression_files],
+                [sample_id for _, sample_id in expression_files],
+                [args.expression_columns] * len(expression_files),
+                [args.dtype] * len(expression_files)
+            )
+            for df_selected in results:
+                if df_selected is None:
                     continue
 
-                # Exclude rows where 'gene_id' starts with 'N_' or 'gene_name' is null
-                df = df[~(df['gene_id'].astype(str).str.startswith('N_') | df['gene_name'].isnull())]
-
-                # Ensure 'gene_id' and 'gene_name' are of string type
-                df['gene_id'] = df['gene_id'].astype(str)
-                df['gene_name'] = df['gene_name'].astype(str)
-
-                # Select expression columns
-                if args.expression_columns:
-                    missing_cols = set(args.expression_columns) - set(df.columns)
-                    if missing_cols:
-                        logger.warning(f"The following expression columns are missing in file {file_path}: {missing_cols}")
-                    selected_columns = [col for col in args.expression_columns if col in df.columns]
-                else:
-                    # Exclude 'gene_id', 'gene_name', and any columns that start with '__'
-                    selected_columns = [col for col in df.columns if col not in ['gene_id', 'gene_name'] and not col.startswith('__')]
-
-                if not selected_columns:
-                    logger.warning(f"No valid expression columns found in file {file_path}. Skipping.")
-                    continue
-
-                # Keep 'gene_id', 'gene_name', and selected expression columns
-                df_selected = df[['gene_id', 'gene_name'] + selected_columns]
-
-                # Rename the expression columns to include the sample identifier
-                df_selected.rename(columns={col: f"{col}_{sample_id}" for col in selected_columns}, inplace=True)
-
                 # Append the DataFrame to the list
                 data_frames.append(df_selected)
                 num_files_processed += 1
 
         if data_frames:
-            # Merge all DataFrames on 'gene_id' and 'gene_name'
-            combined_df = reduce(lambda left, right: pd.merge(left, right, on=['gene_id', 'gene_name'], how='outer'), data_frames)
+            gene_index = data_frames[0].index
+            if all(df.index.equals(gene_index) for df in data_frames[1:]):
+                # Every file lists the same genes in the same order, as STAR gene counts do,
+                # so the columns are placed side by side without aligning or copying them
+                combined_df = pd.DataFrame(
+                    {col: df[col].array for df in data_frames for col in df.columns},
+                    index=gene_index,
+                    copy=False
+                )
+            else:
+                # Align all DataFrames on 'gene_id' and 'gene_name' in a single outer concat
+                combined_df = pd.concat(data_frames, axis=1, join='outer', sort=False)
 
-            # Write the combined data to a TSV file
+            # Write the combined data to a TSV file; the index becomes the 'gene_id' and 'gene_name' columns
             output_file_path = os.path.join(args.output_directory, args.output_file)
-            combined_df.to_csv(output_file_path, sep='\t', index=False)
-            logger.info(f"Combined data saved to {output_file_path}")
-            logger.info(f"Number of files processed and combined: {num_files_processed}")
+            write_combined_tsv(combined_df, output_file_path)
+            logger.info("Combined data saved to %s", output_file_path)
+
+            # Write a Parquet copy alongside the TSV when pyarrow is available; the index is restored when it is read with pandas
+            if not args.no_parquet:
+                if pq is not None:
+                    parquet_file_path = os.path.splitext(output_file_path)[0] + '.parquet'
+                    pq.write_table(pa.Table.from_pandas(combined_df, preserve_index=True), parquet_file_path, compression='zstd')
+                    logger.info("Parquet copy saved to %s", parquet_file_path)
+                else:
+                    logger.info("pyarrow is not installed; skipping the Parquet output")
+            logger.info("Number of files processed and combined: %s", num_files_processed)
         else:
             logger.warning("No data was combined. Please check if the extracted files are present and properly formatted.")
 
     except Exception as e:
-        logger.exception(f"An unexpected error occurred: {e}")
+        logger.exception("An unexpected error occurred: %s", e)
         sys.exit(1)
 
 if __name__ == "__main__":
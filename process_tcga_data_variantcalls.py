@@ -18,9 +18,195 @@ Date:
 
 import os
 import sys
+import gzip
 import argparse
 import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import numpy as np
 import pandas as pd
+from tcga_combine import available_cpu_count, locate_sample_files, setup_logging
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+    pacsv = None
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+# File name suffixes of MAF files
+MAF_SUFFIXES = ('.maf', '.maf.gz')
+
+# Column types used when parsing MAF files, so the parser does not have to infer them; columns with
+# few distinct values are read as categories, which keeps each file's data much smaller
+DESIRED_DTYPES = {
+    'Hugo_Symbol': 'category',
+    'Chromosome': 'category',
+    'Strand': 'category',
+    'Variant_Classification': 'category',
+    'Variant_Type': 'category',
+    'Tumor_Sample_Barcode': 'category',
+    'Matched_Norm_Sample_Barcode': 'category',
+    'Consequence': 'category',
+    'IMPACT': 'category',
+    'callers': 'category',
+    'Start_Position': 'Int64',
+    'End_Position': 'Int64',
+    't_depth': 'Int32',
+    't_ref_count': 'Int32',
+    't_alt_count': 'Int32',
+    'n_depth': 'Int32',
+    'n_ref_count': 'Int32',
+    'n_alt_count': 'Int32'
+}
+
+def read_maf_header(file_path):
+    """
+    Reads the leading comment lines and the column header of a MAF file.
+
+    Args:
+        file_path (str): Path to the MAF file (.maf or .maf.gz).
+
+    Returns:
+        tuple: Number of leading '#' comment lines and the list of column names.
+    """
+    opener = gzip.open if file_path.endswith('.gz') else open
+    num_comment_lines = 0
+    with opener(file_path, 'rt') as maf_file:
+        for line in maf_file:
+            if not line.startswith('#'):
+                return num_comment_lines, line.rstrip('\r\n').split('\t')
+            num_comment_lines += 1
+    return num_comment_lines, []
+
+def parse_maf(file_path, file_id, desired_columns, calculate_vaf):
+    """
+    Reads a single MAF file, keeps the desired columns and adds the File ID and, optionally, the VAF.
+
+    Runs in a worker process, so only the reduced DataFrame is returned to the parent.
+
+    Args:
+        file_path (str): Path to the MAF file (.maf or .maf.gz).
+        file_id (str): GDC File ID of the MAF file.
+        desired_columns (list): Columns to retain from the MAF file.
+        calculate_vaf (bool): Whether to add a 'VAF' column.
+
+    Returns:
+        pandas.DataFrame: The processed MAF data, or None if the file could not be read.
+    """
+    logger = logging.getLogger(__name__)
+    logger.debug("Processing file: %s", file_path)
+
+    # Read the MAF header
+    try:
+        num_comment_lines, columns = read_maf_header(file_path)
+    except Exception as e:
+        logger.error("Failed to read file %s: %s", file_path, e)
+        return None
+
+    # Check if desired columns are present
+    missing_cols = set(desired_columns) - set(columns)
+    if missing_cols:
+        logger.warning("Missing columns %s in file %s. Skipping these columns.", missing_cols, file_path)
+        # Adjust the desired columns to those present
+        present_columns = [col for col in desired_columns if col in columns]
+    else:
+        present_columns = desired_columns
+
+    # Read the MAF file; the pyarrow reader returns Arrow-backed columns (pd.ArrowDtype), which pandas only
+    # supports well enough from 2.0 on
+    try:
+        if pacsv is not None and int(pd.__version__.split('.')[0]) >= 2:
+            # pyarrow streams the file block by block and only materializes the desired columns, so the
+            # rest of the file is never held in memory; the column types are set up front because the
+            # streaming reader would otherwise infer them from the first block alone. Files are parsed in one
+            # thread, as each worker process already has a CPU of its own and Arrow's thread pool would
+            # oversubscribe the job's CPUs
+            arrow_types = {'category': pa.dictionary(pa.int32(), pa.string()), 'Int64': pa.int64(), 'Int32': pa.int32()}
+            column_types = {col: arrow_types[DESIRED_DTYPES[col]] if col in DESIRED_DTYPES else pa.string()
+                            for col in present_columns}
+            with pacsv.open_csv(
+                file_path,
+                read_options=pacsv.ReadOptions(skip_rows=num_comment_lines, use_threads=False),
+                parse_options=pacsv.ParseOptions(delimiter='\t'),
+                convert_options=pacsv.ConvertOptions(
+                    include_columns=present_columns,
+                    column_types=column_types,
+                    # Read missing-value markers such as 'NA' as null in string columns too, as pandas does;
+                    # pandas also treats 'None' and '<NA>' as missing, which pyarrow does not by default
+                    strings_can_be_null=True,
+                    null_values=pacsv.ConvertOptions().null_values + ['None', '<NA>']
+                )
+            ) as reader:
+                table = pa.Table.from_batches(list(reader), schema=reader.schema)
+            # Dictionary-encoded columns become categories; the rest stay Arrow-backed
+            maf = table.to_pandas(types_mapper=lambda arrow_type: None if pa.types.is_dictionary(arrow_type) else pd.ArrowDtype(arrow_type),
+                                  use_threads=False)
+        else:
+            maf = pd.read_csv(
+                file_path,
+                sep='\t',
+                compression='gzip' if file_path.endswith('.gz') else None,
+                comment='#',
+                usecols=present_columns,
+                dtype={col: dtype for col, dtype in DESIRED_DTYPES.items() if col in present_columns},
+                low_memory=False
+            )
+    except Exception as e:
+        logger.error("Failed to read file %s: %s", file_path, e)
+        return None
+
+    # Only the desired columns were parsed; put them in the requested order
+    if list(maf.columns) != present_columns:
+        maf = maf.reindex(columns=present_columns)
+    maf_selected = maf
+
+    # Add the 'File_ID' column; it holds one value per file, so it is stored as a category rather than a string
+    # per row (a file whose sample sheet row has no File ID gets an empty column)
+    maf_selected['File_ID'] = pd.Series(file_id, index=maf_selected.index, dtype='category')
+
+    # Calculate VAF and add as a new column if requested
+    if calculate_vaf:
+        # Ensure required columns are present for VAF calculation
+        if 't_alt_count' in maf_selected.columns and 't_depth' in maf_selected.columns:
+            # Divide the whole columns at once; rows without depth get NaN
+            t_depth = maf_selected['t_depth'].to_numpy(dtype=np.float64, na_value=np.nan)
+            t_alt_count = maf_selected['t_alt_count'].to_numpy(dtype=np.float64, na_value=np.nan)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                vaf = t_alt_count / t_depth
+            vaf[~(t_depth > 0)] = np.nan
+            # Round VAF to 4 decimal places for readability
+            maf_selected['VAF'] = np.round(vaf, 4)
+        else:
+            logger.warning("Columns 't_alt_count' and 't_depth' are required for VAF calculation but are missing in file %s.", file_path)
+
+    logger.debug("Successfully processed file: %s", file_path)
+    return maf_selected
+
+def parquet_schema(output_columns):
+    """
+    Builds the Arrow schema of the Parquet copy of the combined MAF data.
+
+    Every file is cast to this schema, so a column keeps the same type even when a file lacks it.
+    Columns without a known type are stored as strings, as they appear in the TSV.
+
+    Args:
+        output_columns (list): Columns of the combined MAF data.
+
+    Returns:
+        pyarrow.Schema: The schema of the Parquet file.
+    """
+    arrow_types = {'Int64': pa.int64(), 'Int32': pa.int32()}
+    return pa.schema([
+        (col, pa.float64() if col == 'VAF' else arrow_types.get(DESIRED_DTYPES.get(col), pa.string()))
+        for col in output_columns
+    ])
 
 def main():
     # Set up argument parser
@@ -37,42 +223,39 @@ def main():
                         help='List of columns to retain from the MAF files. Default is a predefined set of columns.')
     parser.add_argument('--calculate-vaf', action='store_true',
                         help='Calculate Variant Allele Frequency (VAF) and add it as a new column.')
+    parser.add_argument('--workers', type=int, default=available_cpu_count(),
+                        help='Number of worker processes used to parse MAF files. Default is the number of CPUs available to the job.')
+    parser.add_argument('--no-parquet', action='store_true',
+                        help='Do not write a Parquet copy of the combined MAF data next to the TSV file.')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Enable debug logging, including a message for every processed file.')
     args = parser.parse_args()
 
     # Set up logging
-    logging.basicConfig(
-        level=logging.INFO,
-        format='[%(asctime)s] %(levelname)s:%(name)s: %(message)s',
-        handlers=[
-            logging.FileHandler("process_tcga_maf.log"),
-            logging.StreamHandler(sys.stdout)
-        ]
-    )
+    log_file = "process_tcga_maf.log"
+    setup_logging(log_file, args.verbose)
     logger = logging.getLogger(__name__)
 
     try:
         # Read the sample sheet
         sample_sheet_path = args.sample_sheet
-        logger.info(f"Reading sample sheet from {sample_sheet_path}")
+        logger.info("Reading sample sheet from %s", sample_sheet_path)
         sample_sheet = pd.read_csv(sample_sheet_path, sep="\t")
 
         # Ensure required columns are present
         required_columns = ['File ID', 'File Name', 'Project ID', 'Case ID', 'Sample ID']
         missing_columns = set(required_columns) - set(sample_sheet.columns)
         if missing_columns:
-            logger.error(f"The following required columns are missing from the sample sheet: {missing_columns}")
+            logger.error("The following required columns are missing from the sample sheet: %s", missing_columns)
             sys.exit(1)
 
-        # Create a mapping from File Name to File ID
-        file_name_to_file_id = dict(zip(sample_sheet['File Name'], sample_sheet['File ID']))
-
         # Check for duplicate File Names
-        if sample_sheet['File Name'].duplicated().any():
+        if not sample_sheet['File Name'].is_unique:
             duplicates = sample_sheet[sample_sheet['File Name'].duplicated(keep=False)]
-            logger.warning(f"Duplicate File Names detected. Ensure each File Name is unique.\n{duplicates}")
+            logger.warning("Duplicate File Names detected. Ensure each File Name is unique.\n%s", duplicates)
 
-        # Initialize a list to hold individual DataFrames
-        maf_dfs = []
+        # Initialize a list to hold the MAF files to parse
+        maf_files = []
         num_files_processed = 0
 
         # Define the default columns to retain if not specified
@@ -103,90 +286,100 @@ def main():
         # Use specified columns or default
         desired_columns = args.retain_columns if args.retain_columns else default_desired_columns
 
-        # Iterate over the extracted MAF files
+        # Locate the extracted MAF files listed in the sample sheet
         file_directory = args.file_directory
-        logger.info(f"Processing extracted MAF files in {file_directory}")
+        logger.info("Processing extracted MAF files in %s", file_directory)
 
-        for root, dirs, files in os.walk(file_directory):
-            for file in files:
-                # Identify MAF files (assuming they end with .maf or .maf.gz)
-                if not (file.endswith('.maf') or file.endswith('.maf.gz')):
-                    continue
+        file_ids = sample_sheet['File ID'].tolist()
+        for file_path, row_position in locate_sample_files(file_directory, sample_sheet, MAF_SUFFIXES):
+            # Queue the file with its corresponding File ID
+            maf_files.append((file_path, file_ids[row_position]))
 
-                file_path = os.path.join(root, file)
-                logger.info(f"Processing file: {file_path}")
+        # Every file is written with the same column layout so the rows can be appended to one TSV
+        output_columns = desired_columns + ['File_ID']
+        if args.calculate_vaf and {'t_alt_count', 't_depth'} <= set(desired_columns):
+            output_columns.append('VAF')
 
-                # Check if the File Name is in the sample sheet
-                if file not in file_name_to_file_id:
-                    logger.warning(f"File Name '{file}' not found in sample sheet. Skipping.")
-                    continue
+        # Define the output file path
+        output_file_path = os.path.join(args.output_directory, args.output_file)
+        output_handle = None
+        num_rows_written = 0
+
+        # A Parquet copy is written alongside the TSV when pyarrow is available
+        write_parquet = not args.no_parquet and pq is not None
+        if not args.no_parquet and pq is None:
+            logger.info("pyarrow is not installed; skipping the Parquet output")
+        parquet_file_path = os.path.splitext(output_file_path)[0] + '.parquet'
+        parquet_writer = None
+        output_schema = parquet_schema(output_columns) if write_parquet else None
+
+        # Parse the MAF files in parallel and append each result to the output file as it arrives; at most
+        # two files per worker are submitted ahead of the writer, so the parsed data held at a time does not
+        # grow with the number of files; results are taken in sample sheet order so the output is stable
+        # Both outputs are written under temporary names and only moved into place once every file was
+        # written, so a failed run does not leave a combined file behind that looks complete
+        logger.info("Parsing %s MAF files with up to %s worker processes", len(maf_files), args.workers)
+        output_tmp_path = output_file_path + '.tmp'
+        parquet_tmp_path = parquet_file_path + '.tmp'
+        completed = False
+        try:
+            # The workers set up the same logging, so their per-file messages are kept whatever the start method
+            with ProcessPoolExecutor(max_workers=args.workers, initializer=setup_logging,
+                                     initargs=(log_file, args.verbose)) as executor:
+                remaining_files = iter(maf_files)
+                pending = deque(
+                    executor.submit(parse_maf, file_path, file_id, desired_columns, args.calculate_vaf)
+                    for file_path, file_id in islice(remaining_files, 2 * args.workers)
+                )
+                while pending:
+                    maf_selected = pending.popleft().result()
+
+                    # Submit the next file so the workers keep parsing while this result is written
+                    for file_path, file_id in islice(remaining_files, 1):
+                        pending.append(executor.submit(parse_maf, file_path, file_id, desired_columns, args.calculate_vaf))
+
+                    if maf_selected is None:
+                        continue
+
+                    maf_selected = maf_selected.reindex(columns=output_columns)
+                    if output_handle is None:
+                        output_handle = open(output_tmp_path, 'w', newline='')
+                    maf_selected.to_csv(output_handle, sep='\t', index=False, header=(num_files_processed == 0))
+
+                    if write_parquet:
+                        table = pa.Table.from_pandas(maf_selected, preserve_index=False).cast(output_schema)
+                        if parquet_writer is None:
+                            parquet_writer = pq.ParquetWriter(parquet_tmp_path, output_schema, compression='zstd')
+                        parquet_writer.write_table(table)
+                    num_rows_written += len(maf_selected)
+                    num_files_processed += 1
+            completed = True
+        finally:
+            if output_handle is not None:
+                output_handle.close()
+            if parquet_writer is not None:
+                parquet_writer.close()
 
-                # Get the corresponding File ID
-                file_id = file_name_to_file_id[file]
-
-                # Read the MAF file
-                try:
-                    maf = pd.read_csv(
-                        file_path,
-                        sep='\t',
-                        compression='gzip' if file.endswith('.gz') else None,
-                        comment='#',
-                        low_memory=False
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to read file {file_path}: {e}")
+            for tmp_path, final_path, started in [(output_tmp_path, output_file_path, output_handle is not None),
+                                                  (parquet_tmp_path, parquet_file_path, parquet_writer is not None)]:
+                if not started:
                     continue
+                if completed:
+                    os.replace(tmp_path, final_path)
+                elif os.path.exists(tmp_path):
+                    os.remove(tmp_path)
 
-                # Check if desired columns are present
-                missing_cols = set(desired_columns) - set(maf.columns)
-                if missing_cols:
-                    logger.warning(f"Missing columns {missing_cols} in file {file_path}. Skipping these columns.")
-                    # Adjust the desired columns to those present
-                    present_columns = [col for col in desired_columns if col in maf.columns]
-                else:
-                    present_columns = desired_columns
-
-                # Select the desired columns
-                maf_selected = maf[present_columns].copy()
-
-                # Add the 'File_ID' column
-                maf_selected['File_ID'] = file_id
-
-                # Calculate VAF and add as a new column if requested
-                if args.calculate_vaf:
-                    # Ensure required columns are present for VAF calculation
-                    if 't_alt_count' in maf_selected.columns and 't_depth' in maf_selected.columns:
-                        maf_selected['VAF'] = maf_selected.apply(
-                            lambda row: row['t_alt_count'] / row['t_depth'] if row['t_depth'] > 0 else float('nan'),
-                            axis=1
-                        )
-                        # Round VAF to 4 decimal places for readability
-                        maf_selected['VAF'] = maf_selected['VAF'].round(4)
-                    else:
-                        logger.warning(f"Columns 't_alt_count' and 't_depth' are required for VAF calculation but are missing in file {file_path}.")
-
-                # Append to the list
-                maf_dfs.append(maf_selected)
-                num_files_processed += 1
-                logger.info(f"Successfully processed file: {file_path}")
-
-        if maf_dfs:
-            # Concatenate all DataFrames vertically
-            combined_maf = pd.concat(maf_dfs, ignore_index=True)
-            logger.info(f"Combined MAF DataFrame shape: {combined_maf.shape}")
-
-            # Define the output file path
-            output_file_path = os.path.join(args.output_directory, args.output_file)
-
-            # Save the combined DataFrame to a TSV file
-            combined_maf.to_csv(output_file_path, sep='\t', index=False)
-            logger.info(f"Combined MAF data saved to {output_file_path}")
-            logger.info(f"Number of MAF files processed and combined: {num_files_processed}")
+        if num_files_processed:
+            logger.info("Combined MAF rows written: %s", num_rows_written)
+            logger.info("Combined MAF data saved to %s", output_file_path)
+            if parquet_writer is not None:
+                logger.info("Parquet copy saved to %s", parquet_file_path)
+            logger.info("Number of MAF files processed and combined: %s", num_files_processed)
         else:
             logger.warning("No MAF files were processed. Please check if the extracted files are present and properly formatted.")
 
     except Exception as e:
-        logger.exception(f"An unexpected error occurred: {e}")
+        logger.exception("An unexpected error occurred: %s", e)
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -0,0 +1,166 @@
+"""
+Module Name: tcga_combine.py
+
+Description:
+    Helpers shared by the scripts that process and combine extracted TCGA files: locating the
+    files listed in a GDC sample sheet within the directory they were extracted to, sizing
+    the worker pools to the CPUs available to the job, and setting up logging in every process.
+"""
+
+import os
+import sys
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+
+# Number of threads used to check and list paths in the file directory, which is slow on network file systems
+FILE_LOOKUP_THREADS = 32
+
+def setup_logging(log_file, verbose):
+    """
+    Sends log messages to the log file and stdout.
+
+    Called in the main process and as the initializer of the worker processes, so that messages logged
+    while parsing files are kept when workers are started with spawn or forkserver rather than fork.
+    Forked workers already have the handlers, in which case this does nothing.
+
+    Args:
+        log_file (str): Path of the log file; messages are appended to it.
+        verbose (bool): Whether to log debug messages.
+    """
+    logging.basicConfig(
+        level=logging.DEBUG if verbose else logging.INFO,
+        format='[%(asctime)s] %(levelname)s:%(name)s: %(message)s',
+        handlers=[
+            logging.FileHandler(log_file),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+
+def available_cpu_count():
+    """
+    Returns the number of CPUs this process may run on.
+
+    On a shared node this is the set of CPUs allocated to the job (for example by Slurm),
+    not every CPU in the machine as reported by os.cpu_count().
+
+    Returns:
+        int: Number of usable CPUs.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # os.sched_getaffinity is not available on every platform (e.g. macOS and Windows)
+        return os.cpu_count() or 1
+
+def scan_directory(directory, suffixes):
+    """
+    Lists a single directory, ignoring it if it cannot be read, as os.walk does.
+
+    Args:
+        directory (str): Directory to list.
+        suffixes (str or tuple): File name suffixes to match.
+
+    Returns:
+        tuple: Subdirectories to descend into, and (path, name) tuples of the matching files.
+    """
+    subdirectories = []
+    matching_files = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    # Like os.walk, do not descend into symlinked directories
+                    if not entry.is_symlink():
+                        subdirectories.append(entry.path)
+                elif entry.name.endswith(suffixes):
+                    matching_files.append((entry.path, entry.name))
+    except OSError:
+        pass
+    return subdirectories, matching_files
+
+def iter_files(directory, suffixes):
+    """
+    Walks a directory tree and yields the files whose names end with one of the given suffixes.
+
+    The directories at each level are listed concurrently, since on network file systems each
+    listing mostly waits on the server.
+
+    Args:
+        directory (str): Directory to walk.
+        suffixes (str or tuple): File name suffixes to match.
+
+    Yields:
+        tuple: Path and name of each matching file.
+    """
+    with ThreadPoolExecutor(max_workers=FILE_LOOKUP_THREADS) as executor:
+        pending = [directory]
+        while pending:
+            next_pending = []
+            for subdirectories, matching_files in executor.map(scan_directory, pending, repeat(suffixes)):
+                next_pending.extend(subdirectories)
+                yield from matching_files
+            pending = next_pending
+
+def locate_sample_files(file_directory, sample_sheet, suffixes):
+    """
+    Finds the extracted file for each sample sheet row whose File Name ends with one of the given suffixes.
+
+    GDC archives extract every file to '<File ID>/<File Name>', so that path is checked first; the
+    directory is only walked to find files that are not where they are expected.
+
+    Args:
+        file_directory (str): Directory containing the extracted files.
+        sample_sheet (pandas.DataFrame): Sample sheet with 'File ID' and 'File Name' columns.
+        suffixes (str or tuple): File name suffixes of the files to locate.
+
+    Returns:
+        list: (file_path, row_position) tuples, one per file, where row_position is the position of the
+        file's first row in the sample sheet.
+    """
+    logger = logging.getLogger(__name__)
+
+    candidates = []
+    candidate_paths = set()
+    for row_position, (file_id, file_name) in enumerate(zip(sample_sheet['File ID'], sample_sheet['File Name'])):
+        if not isinstance(file_name, str) or not file_name.endswith(suffixes):
+            continue
+
+        # A row listed more than once in the sample sheet refers to the same file; locate it only once
+        file_path = os.path.join(file_directory, str(file_id), file_name)
+        if file_path in candidate_paths:
+            continue
+        candidate_paths.add(file_path)
+        candidates.append((file_path, file_name, row_position))
+    sheet_file_names = {file_name for _, file_name, _ in candidates}
+
+    # Check the expected paths concurrently, since each check is a round trip on network file systems
+    with ThreadPoolExecutor(max_workers=FILE_LOOKUP_THREADS) as executor:
+        exists = list(executor.map(os.path.isfile, [file_path for file_path, _, _ in candidates]))
+
+    located = []
+    missing = {}
+    for (file_path, file_name, row_position), found in zip(candidates, exists):
+        if found:
+            logger.debug("Found file: %s", file_path)
+            located.append((file_path, row_position))
+        else:
+            missing[file_name] = row_position
+
+    if missing:
+        logger.info("%s files are not at their expected path; searching %s", len(missing), file_directory)
+        located_paths = {file_path for file_path, _ in located}
+        for file_path, file_name in iter_files(file_directory, suffixes):
+            if file_path in located_paths:
+                continue
+
+            if file_name not in sheet_file_names:
+                logger.warning("File Name '%s' not found in sample sheet. Skipping.", file_name)
+                continue
+
+            row_position = missing.get(file_name)
+            if row_position is not None:
+                logger.debug("Found file: %s", file_path)
+                located.append((file_path, row_position))
+
+    return located